@@ -3,9 +3,18 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import torch
 import torch.nn.functional as F
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+import functools
 import math
 import os
+import queue
+import threading
+import time
+
+try:
+    from waitress import serve
+except ImportError:
+    serve = None
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -13,68 +22,249 @@ CORS(app)  # Enable CORS for all routes
 # Define model path - change this to your local Gemma 2 model path
 MODEL_PATH = os.environ.get('MODEL_PATH', '/path/to/gemma-2-9b/2')
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+# Set LOAD_IN_4BIT=1 to serve NF4-quantized weights (CUDA only; scores drift slightly)
+LOAD_IN_4BIT = os.environ.get('LOAD_IN_4BIT', '0') == '1'
+# Set USE_VLLM=1 to serve through vLLM (needs a CUDA GPU; 4-bit loading always uses transformers)
+# vLLM is only imported when requested, since importing it initializes CUDA
+USE_VLLM = os.environ.get('USE_VLLM', '0') == '1'
+
+# Micro-batching settings: a batch is flushed once it is full or the oldest request has waited long enough
+MAX_BATCH = int(os.environ.get('MAX_BATCH', 16))
+MAX_WAIT_MS = int(os.environ.get('MAX_WAIT_MS', 10))
 
-# Initialize tokenizer and model (lazy loading)
+# Initialize tokenizer and model (lazy loading); llm and sampling_params are only set for the vLLM backend
 tokenizer = None
 model = None
+llm = None
+sampling_params = None
 
 def load_model():
     """Lazy load the model and tokenizer when first needed"""
-    global tokenizer, model
+    global tokenizer, model, llm, sampling_params
     
-    if tokenizer is None or model is None:
+    if tokenizer is None or (model is None and llm is None):
         print(f"Loading model from {MODEL_PATH} on {DEVICE}...")
         
+        if USE_VLLM and LOAD_IN_4BIT:
+            print("LOAD_IN_4BIT is not supported with vLLM, falling back to transformers")
+        elif USE_VLLM and DEVICE == 'cuda':
+            try:
+                from vllm import LLM, SamplingParams
+                
+                # Only the prompt is scored; a single generated token is the minimum vLLM allows
+                sampling_params = SamplingParams(max_tokens=1, prompt_logprobs=1)
+                # bf16 needs compute capability 8.0+; older cards (T4, P100) run fp16
+                llm = LLM(
+                    model=MODEL_PATH,
+                    dtype='bfloat16' if torch.cuda.get_device_capability() >= (8, 0) else 'float16',
+                    tensor_parallel_size=torch.cuda.device_count(),
+                )
+                tokenizer = llm.get_tokenizer()
+                print("vLLM engine loaded successfully!")
+                return
+            except Exception as e:
+                print(f"Could not start vLLM, falling back to transformers: {str(e)}")
+        
+        # Loading mirrors TextPerplexityEvaluator in models/ensemble-perplexity-optimizer.py
         tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
-        model = AutoModelForCausalLM.from_pretrained(
-            MODEL_PATH,
-            torch_dtype=torch.float16 if DEVICE == 'cuda' else torch.float32,
-            device_map='auto'
-        )
+        tokenizer.padding_side = 'right'
+        
+        model_kwargs = {
+            'torch_dtype': torch.bfloat16 if DEVICE == 'cuda' else torch.float32,
+            'device_map': 'auto',
+        }
+        if LOAD_IN_4BIT:
+            if DEVICE != 'cuda':
+                raise ValueError('4-bit quantization requires CUDA device')
+            model_kwargs['quantization_config'] = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_quant_type='nf4',
+            )
+        
+        model = None
+        if DEVICE == 'cuda' and torch.cuda.get_device_capability() >= (8, 0):
+            try:
+                model = AutoModelForCausalLM.from_pretrained(
+                    MODEL_PATH, attn_implementation='flash_attention_2', **model_kwargs
+                )
+            except (ImportError, ValueError) as e:
+                print(f"Could not load model with flash_attention_2, using eager attention: {str(e)}")
+        if model is None:
+            model = AutoModelForCausalLM.from_pretrained(
+                MODEL_PATH, attn_implementation='eager', **model_kwargs
+            )
         model.eval()
+        model.requires_grad_(False)
         
         print("Model loaded successfully!")
 
-def calculate_perplexity(text):
-    """Calculate perplexity score for a given text"""
+# Pending requests waiting for the batch worker (lazy started)
+request_queue = queue.Queue()
+batch_worker = None
+batch_worker_lock = threading.Lock()
+
+class PendingRequest:
+    """A single text waiting to be scored by the batch worker"""
+    
+    def __init__(self, text):
+        self.text = text
+        self.done = threading.Event()
+        self.perplexity = None
+        self.error = None
+
+def encode_with_boundaries(texts):
+    """Tokenize texts and wrap each one in BOS/EOS ids, so the tokenizer never re-parses the special token strings"""
+    encoded = tokenizer(texts, add_special_tokens=False)['input_ids']
+    return [[tokenizer.bos_token_id] + ids + [tokenizer.eos_token_id] for ids in encoded]
+
+# Number of positions projected through the LM head at once, bounding peak logits memory
+LOGIT_CHUNK_SIZE = int(os.environ.get('LOGIT_CHUNK_SIZE', 32))
+
+# Mirrors masked_nll_sum in models/ensemble-perplexity-optimizer.py; keep in sync
+def masked_nll_sum(logits, labels, mask, softcap=None):
+    """Sum per-text negative log-likelihood of the labels over unmasked positions"""
+    logits = logits.float()
+    if softcap is not None:
+        logits = torch.tanh(logits / softcap) * softcap
+    token_nll = -torch.log_softmax(logits, dim=-1).gather(-1, labels.unsqueeze(-1)).squeeze(-1)
+    return (token_nll * mask).sum(dim=1)
+
+if DEVICE == 'cuda':
+    masked_nll_sum = torch.compile(masked_nll_sum, dynamic=True)
+
+# Mirrors VLLMPerplexityEvaluator.compute_batch_perplexity in models/ensemble-perplexity-optimizer.py; keep in sync
+def calculate_batch_perplexity_vllm(texts):
+    """Calculate perplexity scores for a list of texts from vLLM prompt log-probabilities"""
+    encoded = encode_with_boundaries(texts)
+    
+    outputs = llm.generate(
+        [{'prompt_token_ids': ids} for ids in encoded],
+        sampling_params,
+        use_tqdm=False,
+    )
+    
+    perplexities = []
+    for ids, output in zip(encoded, outputs):
+        token_logprobs = [
+            position_logprobs[token_id].logprob
+            for token_id, position_logprobs in zip(ids[1:], output.prompt_logprobs[1:])
+        ]
+        perplexities.append(math.exp(-sum(token_logprobs) / len(token_logprobs)))
+    
+    return perplexities
+
+def calculate_batch_perplexity(texts):
+    """Calculate perplexity scores for a list of texts in one padded forward pass"""
     load_model()  # Ensure model is loaded
     
-    with torch.no_grad():
-        # Add sequence boundary tokens
-        text_with_special = f"{tokenizer.bos_token}{text}{tokenizer.eos_token}"
-        
-        # Tokenize
-        model_inputs = tokenizer(
-            text_with_special,
+    if llm is not None:
+        return calculate_batch_perplexity_vllm(texts)
+    
+    with torch.inference_mode():
+        # Tokenize and right-pad to the longest text in the batch
+        model_inputs = tokenizer.pad(
+            {'input_ids': encode_with_boundaries(texts)},
             return_tensors='pt',
-            add_special_tokens=False,
         )
+        if DEVICE == 'cuda':
+            model_inputs = {k: v.pin_memory() for k, v in model_inputs.items()}
+        model_inputs = {k: v.to(DEVICE, non_blocking=True) for k, v in model_inputs.items()}
         
-        if 'token_type_ids' in model_inputs:
-            model_inputs.pop('token_type_ids')
+        # Run the decoder only; the LM head is applied chunk by chunk below
+        hidden_states = model.get_decoder()(
+            input_ids=model_inputs['input_ids'],
+            attention_mask=model_inputs['attention_mask'],
+            use_cache=False,
+        ).last_hidden_state
         
-        model_inputs = {k: v.to(DEVICE) for k, v in model_inputs.items()}
+        # Shift hidden states, labels and mask for calculating loss
+        shift_hidden = hidden_states[:, :-1, :]
+        shift_labels = model_inputs['input_ids'][:, 1:]
+        shift_mask = model_inputs['attention_mask'][:, 1:].float()
         
-        # Get model output
-        output = model(**model_inputs, use_cache=False)
-        logits = output['logits']
+        # Mirrors TextPerplexityEvaluator._chunked_nll_sum in models/ensemble-perplexity-optimizer.py; keep in sync
+        lm_head = model.get_output_embeddings()
+        softcap = getattr(model.config, 'final_logit_softcapping', None)
+        logits_device = lm_head.weight.device
+        total_loss = torch.zeros(len(texts), device=logits_device)
+        for start in range(0, shift_hidden.size(1), LOGIT_CHUNK_SIZE):
+            end = start + LOGIT_CHUNK_SIZE
+            logits = lm_head(shift_hidden[:, start:end, :].to(logits_device))
+            total_loss += masked_nll_sum(
+                logits,
+                shift_labels[:, start:end].to(logits.device),
+                shift_mask[:, start:end].to(logits.device),
+                softcap,
+            )
         
-        # Shift logits and labels for calculating loss
-        shift_logits = logits[..., :-1, :].contiguous()
-        shift_labels = model_inputs['input_ids'][..., 1:].contiguous()
-        
-        # Calculate token-wise loss
-        loss_fct = torch.nn.CrossEntropyLoss(reduction='none')
-        loss = loss_fct(
-            shift_logits.view(-1, shift_logits.size(-1)),
-            shift_labels.view(-1)
-        )
+        # Calculate perplexity for each text
+        return torch.exp(total_loss.to(shift_mask.device) / shift_mask.sum(dim=1)).tolist()
+
+def run_batch_worker():
+    """Collect queued requests into batches and score them until the process exits"""
+    while True:
+        batch = [request_queue.get()]
+        deadline = time.monotonic() + MAX_WAIT_MS / 1000
         
-        # Calculate perplexity
-        sequence_loss = loss.sum() / len(loss)
-        perplexity = torch.exp(sequence_loss).item()
+        # Keep collecting until the batch is full or the wait budget runs out
+        while len(batch) < MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(request_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
         
-        return perplexity
+        try:
+            # Identical texts in the same batch are scored once
+            unique_texts = list(dict.fromkeys(pending.text for pending in batch))
+            perplexities = dict(zip(unique_texts, calculate_batch_perplexity(unique_texts)))
+            for pending in batch:
+                pending.perplexity = perplexities[pending.text]
+        except Exception as e:
+            if len(unique_texts) == 1 or (model is None and llm is None):
+                # Nothing to isolate: a single text, or the model itself failed to load
+                for pending in batch:
+                    pending.error = e
+            else:
+                # Retry one text at a time so a single bad text only fails its own requests
+                for text in unique_texts:
+                    pending_for_text = [pending for pending in batch if pending.text == text]
+                    try:
+                        perplexity = calculate_batch_perplexity([text])[0]
+                        for pending in pending_for_text:
+                            pending.perplexity = perplexity
+                    except Exception as item_error:
+                        for pending in pending_for_text:
+                            pending.error = item_error
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+def start_batch_worker():
+    """Start the background batch worker if it is not running yet"""
+    global batch_worker
+    
+    with batch_worker_lock:
+        if batch_worker is None:
+            batch_worker = threading.Thread(target=run_batch_worker, daemon=True)
+            batch_worker.start()
+
+@functools.lru_cache(maxsize=4096)
+def calculate_perplexity(text):
+    """Calculate perplexity score for a given text (memoized per text)"""
+    start_batch_worker()  # Ensure requests are being consumed
+    
+    pending = PendingRequest(text)
+    request_queue.put(pending)
+    pending.done.wait()
+    
+    if pending.error is not None:
+        raise pending.error
+    
+    return pending.perplexity
 
 @app.route('/calculate-perplexity', methods=['POST'])
 def perplexity_endpoint():
@@ -83,6 +273,9 @@ def perplexity_endpoint():
     if not data or 'text' not in data:
         return jsonify({'error': 'Text is required'}), 400
     
+    if not isinstance(data['text'], str):
+        return jsonify({'error': 'Text must be a string'}), 400
+    
     try:
         text = data['text']
         perplexity = calculate_perplexity(text)
@@ -102,4 +295,8 @@ if __name__ == '__main__':
     
     # Run the Flask server
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    # Concurrent requests must be served by separate threads so they can share a batch
+    if serve is not None:
+        serve(app, host='0.0.0.0', port=port, threads=MAX_BATCH * 2)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
\ No newline at end of file